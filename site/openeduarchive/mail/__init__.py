@@ -1,5 +1,6 @@
 """OAuth2 email integration for Microsoft Graph API."""
 
-from .oauth2 import init_app
+from ._graph import RetryAfter
+from .oauth2 import bulk_send, init_app, send_many
 
-__all__ = ["init_app"]
+__all__ = ["RetryAfter", "bulk_send", "init_app", "send_many"]
@@ -0,0 +1,779 @@
+"""Microsoft Graph API mail client shared by the mail backend and scripts.
+
+GraphMailer bundles everything needed to send mail through Graph for one
+configured identity and sender: the MSAL application and its token cache,
+an in-process access token cache, a pooled HTTP session and the retry
+policy. It has no Flask dependency, so both the Flask-Mail backend
+(oauth2.py) and the standalone test_send.py script use it.
+
+Use get_mailer(config) to get the process-wide instance for a config.
+"""
+
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import quote
+
+try:
+    import orjson
+
+    def _dumps(payload):
+        """Serialize a request body to UTF-8 JSON bytes."""
+        return orjson.dumps(payload)
+except ImportError:
+    import json
+
+    def _dumps(payload):
+        """Serialize a request body to UTF-8 JSON bytes."""
+        return json.dumps(payload).encode("utf-8")
+
+logger = logging.getLogger(__name__)
+
+# msal and requests are heavy imports (msal pulls in cryptography) and are
+# not needed unless mail is actually sent through Graph, so they are
+# imported on first use by _import_msal() / _import_requests().
+_msal = None
+_requests = None
+
+_GRAPH_API_SEND_URL = "https://graph.microsoft.com/v1.0"
+_GRAPH_API_TIMEOUT = 30
+
+_RETRYABLE_STATUS_CODES = {401, 429, 500, 502, 503, 504}
+_MAX_RETRIES = 2
+
+# Retry waits are kept short so a throttled send never stalls a worker for
+# long: 5xx/network errors back off exponentially up to _BACKOFF_CAP
+# seconds, and a 429 Retry-After above _RETRY_AFTER_CAP seconds raises
+# RetryAfter instead of sleeping. Jitter de-correlates concurrent retries.
+_BACKOFF_CAP = 8
+_RETRY_AFTER_CAP = 10
+
+# Graph JSON batching accepts at most 20 sub-requests per $batch call.
+GRAPH_BATCH_MAX_REQUESTS = 20
+
+# Connection pool of each mailer's HTTP session. Retries are handled by
+# GraphMailer itself, so the adapter never retries.
+_HTTP_POOL_CONNECTIONS = 4
+_HTTP_POOL_MAXSIZE = 32
+
+# Access tokens are served from the in-process cache until
+# _TOKEN_EXPIRY_BUFFER seconds before they expire.
+_TOKEN_EXPIRY_BUFFER = 60
+
+# Delegated flow: token cache writes are rate-limited to one every
+# _TOKEN_CACHE_PERSIST_INTERVAL seconds; pending changes are flushed by
+# flush_token_caches() at exit.
+_TOKEN_CACHE_PERSIST_INTERVAL = 30
+
+VALID_FLOWS = ("client_credentials", "delegated")
+
+_FLOW_SCOPES = {
+    "client_credentials": ("https://graph.microsoft.com/.default",),
+    "delegated": ("https://graph.microsoft.com/Mail.Send",),
+}
+
+
+class RetryAfter(RuntimeError):
+    """Graph API throttling outlasted what the send path is willing to wait.
+
+    Raised instead of blocking the caller, so that a task queue can
+    reschedule the send. ``retry_after`` holds the delay (in seconds)
+    requested by Graph, or None if it did not send one.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+def _import_msal():
+    """Import msal on first use."""
+    global _msal
+    if _msal is None:
+        import msal
+        _msal = msal
+    return _msal
+
+
+def _import_requests():
+    """Import requests on first use."""
+    global _requests
+    if _requests is None:
+        import requests
+        _requests = requests
+    return _requests
+
+
+def build_authority(tenant_id):
+    """Build the MSAL authority URL from a tenant identifier.
+
+    Args:
+        tenant_id: Entra ID tenant GUID, "consumers", or "common".
+    """
+    return f"https://login.microsoftonline.com/{tenant_id}"
+
+
+def _graph_send_path(flow, sender_email):
+    """Return the sendMail path, relative to the Graph API version root.
+
+    /me/sendMail for delegated, /users/{email}/sendMail for app-only.
+    """
+    if flow == "delegated":
+        return "/me/sendMail"
+    return f"/users/{quote(sender_email, safe='@')}/sendMail"
+
+
+def _parse_retry_after(value):
+    """Parse a Retry-After header value (seconds). Returns None if absent."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _jitter(wait):
+    """Add up to 50% random jitter to a wait time."""
+    return wait + random.uniform(0, 0.5 * wait)
+
+
+def _backoff_delay(attempt):
+    """Capped exponential backoff with jitter for network errors and 5xx."""
+    return _jitter(min(2 ** attempt, _BACKOFF_CAP))
+
+
+def _throttle_delay(retry_after, attempt):
+    """Wait time for a 429 response, given its Retry-After header value.
+
+    Raises:
+        RetryAfter: If Graph asks to wait longer than _RETRY_AFTER_CAP.
+    """
+    wait = _parse_retry_after(retry_after)
+    if wait is None:
+        return _backoff_delay(attempt)
+    if wait > _RETRY_AFTER_CAP:
+        raise RetryAfter(
+            f"Graph API throttled sendMail, retry after {wait:g}s", wait
+        )
+    return _jitter(wait)
+
+
+def _recipients_of(payload):
+    """Return the To addresses of a sendMail payload (for logging)."""
+    return [
+        r["emailAddress"]["address"]
+        for r in payload["message"].get("toRecipients", ())
+    ]
+
+
+def flask_message_to_graph_payload(message, sender_email):
+    """Convert a flask_mail.Message to a Microsoft Graph API sendMail payload.
+
+    Args:
+        message: A flask_mail.Message instance.
+        sender_email: The sender email address (from config).
+
+    Returns:
+        A dict suitable for JSON serialization as the Graph API request body.
+    """
+    graph_message = {
+        "subject": message.subject or "",
+        "body": {
+            "contentType": "HTML" if message.html else "Text",
+            "content": message.html or message.body or "",
+        },
+        "toRecipients": [
+            {"emailAddress": {"address": addr}} for addr in message.recipients or ()
+        ],
+        "from": {"emailAddress": {"address": sender_email}},
+    }
+
+    # Graph treats an absent recipient list the same as an empty one.
+    if message.cc:
+        graph_message["ccRecipients"] = [
+            {"emailAddress": {"address": addr}} for addr in message.cc
+        ]
+    if message.bcc:
+        graph_message["bccRecipients"] = [
+            {"emailAddress": {"address": addr}} for addr in message.bcc
+        ]
+
+    if message.reply_to:
+        reply_to = message.reply_to
+        if isinstance(reply_to, str):
+            reply_to = [reply_to]
+        graph_message["replyTo"] = [
+            {"emailAddress": {"address": addr}} for addr in reply_to
+        ]
+
+    return {"message": graph_message, "saveToSentItems": False}
+
+
+# ---------------------------------------------------------------------------
+# Graph mail client
+# ---------------------------------------------------------------------------
+
+class GraphMailer:
+    """Send mail through Microsoft Graph for one OAuth2 identity.
+
+    Thread-safe. The access token is cached in-process and shared by all
+    sends; the HTTP session keeps connections to Graph alive.
+
+    Args:
+        tenant_id: Entra ID tenant GUID, or "consumers".
+        client_id: App registration client ID.
+        client_secret: App registration client secret.
+        flow: "client_credentials" or "delegated".
+        sender_email: Sender mailbox address.
+        token_cache_file: Delegated flow only: path to the MSAL token cache.
+    """
+
+    def __init__(self, tenant_id, client_id, client_secret, flow,
+                 sender_email, token_cache_file=""):
+        if flow not in VALID_FLOWS:
+            raise RuntimeError(f"Invalid MAIL_OAUTH2_FLOW: '{flow}'")
+
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.flow = flow
+        self.sender_email = sender_email
+        self.token_cache_file = token_cache_file if flow == "delegated" else ""
+        self._client_secret = client_secret
+        self._scopes = list(_FLOW_SCOPES[flow])
+
+        self._send_path = _graph_send_path(flow, sender_email)
+        self._send_url = _GRAPH_API_SEND_URL + self._send_path
+        self._batch_url = f"{_GRAPH_API_SEND_URL}/$batch"
+
+        requests = _import_requests()
+        from requests.adapters import HTTPAdapter
+
+        self._http = requests.Session()
+        self._http.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=_HTTP_POOL_CONNECTIONS,
+                pool_maxsize=_HTTP_POOL_MAXSIZE,
+                max_retries=0,
+            ),
+        )
+        self._http.headers["Content-Type"] = "application/json"
+
+        self._msal_app = None
+        self._msal_app_lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self._last_persist_ts = None
+
+        # (access_token, expires_at on the time.monotonic() clock)
+        self._token = None
+        self._auth_headers = None
+        self._token_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a mailer from a MAIL_OAUTH2_* config mapping."""
+        return cls(
+            tenant_id=config["MAIL_OAUTH2_TENANT_ID"],
+            client_id=config["MAIL_OAUTH2_CLIENT_ID"],
+            client_secret=config["MAIL_OAUTH2_CLIENT_SECRET"],
+            flow=config["MAIL_OAUTH2_FLOW"],
+            sender_email=config["MAIL_OAUTH2_SENDER_EMAIL"],
+            token_cache_file=config.get("MAIL_OAUTH2_TOKEN_CACHE_FILE", ""),
+        )
+
+    # -- MSAL token management ---------------------------------------------
+
+    def _get_msal_app(self):
+        """Get or create the MSAL ConfidentialClientApplication."""
+        with self._msal_app_lock:
+            if self._msal_app is not None:
+                return self._msal_app
+
+            msal = _import_msal()
+            token_cache = msal.SerializableTokenCache()
+            if self.token_cache_file:
+                try:
+                    with open(self.token_cache_file, "r") as f:
+                        token_cache.deserialize(f.read())
+                except FileNotFoundError:
+                    pass
+
+            self._msal_app = msal.ConfidentialClientApplication(
+                client_id=self.client_id,
+                client_credential=self._client_secret,
+                authority=build_authority(self.tenant_id),
+                token_cache=token_cache,
+            )
+            return self._msal_app
+
+    def persist_token_cache(self, force=False):
+        """Atomically persist the MSAL token cache to disk.
+
+        Only relevant for the delegated flow. Writes to a temp file first,
+        then atomically replaces the target to avoid corruption. File
+        permissions are set to 0600 (owner read/write only).
+
+        Unless force is True, at most one write happens every
+        _TOKEN_CACHE_PERSIST_INTERVAL seconds; skipped changes stay
+        pending and are written by a later call.
+        """
+        cache_file = self.token_cache_file
+        if not cache_file or self._msal_app is None:
+            return
+
+        cache = self._msal_app.token_cache
+        if not getattr(cache, "has_state_changed", False):
+            return
+
+        with self._persist_lock:
+            now = time.monotonic()
+            if (
+                not force
+                and self._last_persist_ts is not None
+                and now - self._last_persist_ts < _TOKEN_CACHE_PERSIST_INTERVAL
+            ):
+                return
+
+            tmp_file = cache_file + ".tmp"
+            try:
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    f.write(cache.serialize())
+                os.replace(tmp_file, cache_file)
+                cache.has_state_changed = False
+                self._last_persist_ts = now
+                logger.debug("OAuth2 token cache persisted to %s", cache_file)
+            except OSError:
+                logger.exception("Failed to persist OAuth2 token cache to %s", cache_file)
+                try:
+                    os.unlink(tmp_file)
+                except OSError:
+                    pass
+
+    def acquire_token(self, refresh=False):
+        """Acquire a valid OAuth2 access token.
+
+        Served from the in-process token cache while the cached token is
+        not within _TOKEN_EXPIRY_BUFFER seconds of expiry (unless refresh
+        is True). Otherwise:
+
+        For client_credentials: fetches a new token using app identity.
+        For delegated: silently refreshes using the cached refresh token.
+
+        Args:
+            refresh: Skip the in-process cache and always ask MSAL.
+
+        Returns:
+            The access token string.
+
+        Raises:
+            RuntimeError: If token acquisition fails.
+        """
+        if not refresh:
+            cached = self._token
+            if cached and time.monotonic() < cached[1] - _TOKEN_EXPIRY_BUFFER:
+                return cached[0]
+
+        msal_app = self._get_msal_app()
+
+        if self.flow == "client_credentials":
+            result = msal_app.acquire_token_for_client(scopes=self._scopes)
+        else:
+            accounts = msal_app.get_accounts()
+            if not accounts:
+                raise RuntimeError(
+                    "No cached OAuth2 account found. Run "
+                    "'python -m openeduarchive.mail' first."
+                )
+            result = msal_app.acquire_token_silent(
+                scopes=self._scopes, account=accounts[0],
+            )
+            if result and "access_token" in result:
+                self.persist_token_cache()
+
+        if not result or "access_token" not in result:
+            error_detail = "unknown error"
+            if result:
+                error_detail = result.get(
+                    "error_description", result.get("error", "unknown error")
+                )
+            raise RuntimeError(f"OAuth2 token acquisition failed: {error_detail}")
+
+        access_token = result["access_token"]
+        expires_in = result.get("expires_in")
+        if expires_in:
+            with self._token_lock:
+                self._token = (access_token, time.monotonic() + int(expires_in))
+        return access_token
+
+    def invalidate_token(self):
+        """Drop the cached access token (e.g. after a 401)."""
+        with self._token_lock:
+            self._token = None
+
+    @property
+    def token_expires_at(self):
+        """Expiry of the cached access token (time.monotonic()), or None."""
+        cached = self._token
+        return cached[1] if cached else None
+
+    def _headers_for(self, access_token):
+        """Return the Authorization header dict, rebuilt only on rotation."""
+        headers = self._auth_headers
+        if headers is None or headers[0] != access_token:
+            headers = (access_token, {"Authorization": f"Bearer {access_token}"})
+            self._auth_headers = headers
+        return headers[1]
+
+    # -- Sending -------------------------------------------------------------
+
+    def _build_payload(self, message):
+        """Return the sendMail payload for a flask_mail.Message or a dict.
+
+        A dict is taken to be a ready-made Graph sendMail payload.
+        """
+        if isinstance(message, dict):
+            return message
+        return flask_message_to_graph_payload(message, self.sender_email)
+
+    def send(self, message):
+        """Send an email through the Microsoft Graph API.
+
+        Args:
+            message: A flask_mail.Message instance, or a Graph sendMail
+                payload dict.
+
+        Raises:
+            RetryAfter: If Graph keeps throttling the request.
+            RuntimeError: If the API call fails.
+        """
+        access_token = self.acquire_token()
+        payload = self._build_payload(message)
+
+        last_response = None
+
+        for attempt in range(_MAX_RETRIES + 1):
+            try:
+                last_response = self._http.post(
+                    self._send_url,
+                    headers=self._headers_for(access_token),
+                    data=_dumps(payload),
+                    timeout=_GRAPH_API_TIMEOUT,
+                )
+            except _requests.RequestException as exc:
+                logger.warning(
+                    "Graph API request failed: %s (attempt %d/%d)",
+                    exc, attempt + 1, _MAX_RETRIES + 1,
+                )
+                if attempt < _MAX_RETRIES:
+                    time.sleep(_backoff_delay(attempt))
+                    continue
+                raise RuntimeError(f"Graph API sendMail request failed: {exc}") from exc
+
+            if last_response.status_code == 202:
+                recipients = _recipients_of(payload)
+                logger.info("Email sent via Graph API (recipients=%d)", len(recipients))
+                logger.debug(
+                    "Email sent via Graph API: to=%s subject='%s'",
+                    recipients,
+                    payload["message"].get("subject", ""),
+                )
+                return
+
+            if last_response.status_code not in _RETRYABLE_STATUS_CODES:
+                break
+
+            if attempt < _MAX_RETRIES:
+                # Re-acquire token on 401 (expired mid-flight)
+                if last_response.status_code == 401:
+                    logger.warning(
+                        "Graph API returned 401, re-acquiring token (attempt %d/%d)",
+                        attempt + 1, _MAX_RETRIES,
+                    )
+                    self.invalidate_token()
+                    access_token = self.acquire_token()
+                    wait = 1
+                elif last_response.status_code == 429:
+                    # Respect Microsoft's Retry-After header on throttling
+                    try:
+                        wait = _throttle_delay(
+                            last_response.headers.get("Retry-After"), attempt
+                        )
+                    except RetryAfter:
+                        # Too long to wait here: fall through to the
+                        # failure log, which raises RetryAfter for a 429.
+                        break
+                else:
+                    wait = _backoff_delay(attempt)
+
+                logger.warning(
+                    "Graph API returned %d, retrying in %.1fs (attempt %d/%d)",
+                    last_response.status_code, wait, attempt + 1, _MAX_RETRIES,
+                )
+                time.sleep(wait)
+
+        request_id = last_response.headers.get("request-id", "?")
+        logger.error(
+            "Graph API sendMail failed: status=%d request-id=%s body=%s",
+            last_response.status_code,
+            request_id,
+            last_response.text[:500],
+        )
+        if last_response.status_code == 429:
+            raise RetryAfter(
+                f"Graph API sendMail throttled (429): request-id={request_id}",
+                _parse_retry_after(last_response.headers.get("Retry-After")),
+            )
+        raise RuntimeError(
+            f"Graph API sendMail failed ({last_response.status_code}): "
+            f"request-id={request_id} {last_response.text[:200]}"
+        )
+
+    def send_batch(self, messages):
+        """Send up to 20 emails in a single Graph API $batch request.
+
+        Each message becomes one sendMail sub-request. Sub-requests that
+        fail with a retryable status are resent in a new, smaller batch,
+        honoring the largest Retry-After among them.
+
+        Args:
+            messages: A list of at most GRAPH_BATCH_MAX_REQUESTS
+                flask_mail.Message instances or sendMail payload dicts.
+
+        Returns:
+            A list with one entry per message, in order: None if the
+            message was sent, or an exception describing why it was not.
+        """
+        if len(messages) > GRAPH_BATCH_MAX_REQUESTS:
+            raise ValueError(
+                f"A Graph API $batch accepts at most {GRAPH_BATCH_MAX_REQUESTS} "
+                f"messages, got {len(messages)}"
+            )
+
+        results = [None] * len(messages)
+        try:
+            access_token = self.acquire_token()
+        except Exception as exc:
+            return [exc] * len(messages)
+
+        pending = {
+            str(i): self._build_payload(message) for i, message in enumerate(messages)
+        }
+
+        for attempt in range(_MAX_RETRIES + 1):
+            batch = {
+                "requests": [
+                    {
+                        "id": request_id,
+                        "method": "POST",
+                        "url": self._send_path,
+                        "body": payload,
+                        "headers": {"Content-Type": "application/json"},
+                    }
+                    for request_id, payload in pending.items()
+                ]
+            }
+
+            try:
+                response = self._http.post(
+                    self._batch_url,
+                    headers=self._headers_for(access_token),
+                    data=_dumps(batch),
+                    timeout=_GRAPH_API_TIMEOUT,
+                )
+            except _requests.RequestException as exc:
+                logger.warning(
+                    "Graph API $batch request failed: %s (attempt %d/%d)",
+                    exc, attempt + 1, _MAX_RETRIES + 1,
+                )
+                if attempt < _MAX_RETRIES:
+                    time.sleep(_backoff_delay(attempt))
+                    continue
+                for request_id in pending:
+                    results[int(request_id)] = RuntimeError(
+                        f"Graph API $batch request failed: {exc}"
+                    )
+                return results
+
+            if response.status_code != 200:
+                request_id = response.headers.get("request-id", "?")
+                error = None
+                if response.status_code in _RETRYABLE_STATUS_CODES and attempt < _MAX_RETRIES:
+                    try:
+                        if response.status_code == 401:
+                            self.invalidate_token()
+                            access_token = self.acquire_token()
+                            wait = 1
+                        elif response.status_code == 429:
+                            wait = _throttle_delay(
+                                response.headers.get("Retry-After"), attempt
+                            )
+                        else:
+                            wait = _backoff_delay(attempt)
+                    except Exception as exc:
+                        # RetryAfter, or the token could not be re-acquired.
+                        error = exc
+                    else:
+                        logger.warning(
+                            "Graph API $batch returned %d, retrying in %.1fs "
+                            "(attempt %d/%d)",
+                            response.status_code, wait, attempt + 1, _MAX_RETRIES,
+                        )
+                        time.sleep(wait)
+                        continue
+
+                logger.error(
+                    "Graph API $batch failed: status=%d request-id=%s body=%s",
+                    response.status_code, request_id, response.text[:500],
+                )
+                if error is None and response.status_code == 429:
+                    error = RetryAfter(
+                        f"Graph API $batch throttled (429): request-id={request_id}",
+                        _parse_retry_after(response.headers.get("Retry-After")),
+                    )
+                if error is None:
+                    error = RuntimeError(
+                        f"Graph API $batch failed ({response.status_code}): "
+                        f"request-id={request_id} {response.text[:200]}"
+                    )
+                for sub_id in pending:
+                    results[int(sub_id)] = error
+                return results
+
+            try:
+                responses = response.json().get("responses", [])
+            except ValueError as exc:
+                logger.error(
+                    "Graph API $batch returned malformed JSON: request-id=%s body=%s",
+                    response.headers.get("request-id", "?"), response.text[:500],
+                )
+                for sub_id in pending:
+                    results[int(sub_id)] = RuntimeError(
+                        f"Graph API $batch returned malformed JSON: {exc}"
+                    )
+                return results
+
+            retry = {}
+            wait = 0
+            sent = 0
+            token_expired = False
+            answered = set()
+            for sub in responses:
+                sub_id = sub.get("id")
+                payload = pending.get(sub_id)
+                if payload is None:
+                    continue
+                answered.add(sub_id)
+                status = sub.get("status")
+
+                if status == 202:
+                    sent += 1
+                    logger.debug(
+                        "Email sent via Graph API $batch: to=%s subject='%s'",
+                        _recipients_of(payload),
+                        payload["message"].get("subject", ""),
+                    )
+                    continue
+
+                headers = {k.lower(): v for k, v in (sub.get("headers") or {}).items()}
+
+                if status in _RETRYABLE_STATUS_CODES and attempt < _MAX_RETRIES:
+                    try:
+                        if status == 429:
+                            delay = _throttle_delay(headers.get("retry-after"), attempt)
+                        else:
+                            delay = 1 if status == 401 else _backoff_delay(attempt)
+                    except RetryAfter as exc:
+                        results[int(sub_id)] = exc
+                        continue
+                    wait = max(wait, delay)
+                    token_expired = token_expired or status == 401
+                    retry[sub_id] = payload
+                    continue
+
+                if status == 429:
+                    results[int(sub_id)] = RetryAfter(
+                        "Graph API sendMail throttled (429) in $batch",
+                        _parse_retry_after(headers.get("retry-after")),
+                    )
+                    continue
+
+                error = (sub.get("body") or {}).get("error") or {}
+                results[int(sub_id)] = RuntimeError(
+                    f"Graph API sendMail failed ({status}) in $batch: "
+                    f"{error.get('code', '?')} {error.get('message', '')[:200]}"
+                )
+
+            for sub_id in pending.keys() - answered:
+                results[int(sub_id)] = RuntimeError(
+                    f"Graph API $batch returned no response for sub-request {sub_id}"
+                )
+
+            logger.info("Emails sent via Graph API $batch: %d/%d", sent, len(pending))
+
+            if not retry:
+                return results
+
+            if token_expired:
+                self.invalidate_token()
+                try:
+                    access_token = self.acquire_token()
+                except Exception as exc:
+                    for sub_id in retry:
+                        results[int(sub_id)] = exc
+                    return results
+
+            logger.warning(
+                "Graph API $batch: %d sub-requests retryable, retrying in %.1fs "
+                "(attempt %d/%d)",
+                len(retry), wait, attempt + 1, _MAX_RETRIES,
+            )
+            pending = retry
+            time.sleep(wait)
+
+        return results
+
+
+# ---------------------------------------------------------------------------
+# Process-wide mailers
+# ---------------------------------------------------------------------------
+
+# One GraphMailer per distinct MAIL_OAUTH2_* configuration (credentials,
+# flow, sender mailbox and token cache file), reused across requests within
+# the same process so they share the warm session and token.
+_mailers = {}
+_mailers_lock = threading.Lock()
+
+
+def get_mailer(config):
+    """Get or create the process-wide GraphMailer for a config mapping."""
+    key = (
+        config["MAIL_OAUTH2_TENANT_ID"],
+        config["MAIL_OAUTH2_CLIENT_ID"],
+        config["MAIL_OAUTH2_CLIENT_SECRET"],
+        config["MAIL_OAUTH2_FLOW"],
+        config["MAIL_OAUTH2_SENDER_EMAIL"],
+        config.get("MAIL_OAUTH2_TOKEN_CACHE_FILE", ""),
+    )
+    mailer = _mailers.get(key)
+    if mailer is None:
+        with _mailers_lock:
+            mailer = _mailers.get(key)
+            if mailer is None:
+                mailer = _mailers[key] = GraphMailer.from_config(config)
+    return mailer
+
+
+def flush_token_caches():
+    """Write any pending token cache changes, bypassing the rate limit."""
+    for mailer in list(_mailers.values()):
+        mailer.persist_token_cache(force=True)
+
+
+atexit.register(flush_token_caches)
@@ -33,293 +33,123 @@ Security:
   file (delegated). Never logged, never exposed.
 """
 
+import atexit
 import logging
 import os
 import stat
 import threading
 import time
-from urllib.parse import quote
+import types
+from concurrent.futures import ThreadPoolExecutor
 
-import flask_mail
-import msal
-import requests
+from ._graph import (
+    GRAPH_BATCH_MAX_REQUESTS,
+    VALID_FLOWS,
+    get_mailer,
+)
 
 logger = logging.getLogger(__name__)
 
-_GRAPH_API_SEND_URL = "https://graph.microsoft.com/v1.0"
-_GRAPH_API_TIMEOUT = 30
-
-# Original Flask-Mail methods, saved before patching.
-_original_configure_host = flask_mail.Connection.configure_host
-_original_send = flask_mail.Connection.send
-
-# Thread-safe MSAL app cache. One ConfidentialClientApplication per
-# (tenant, client, flow) tuple, reused across requests within the same
-# process. MSAL handles token caching and refresh internally.
-_msal_apps = {}
-_msal_apps_lock = threading.Lock()
-_cache_persist_lock = threading.Lock()
+# Upper bound on concurrent sends in send_many(); kept below the mailer's
+# HTTP pool size so every worker gets a pooled connection.
+_SEND_MANY_MAX_WORKERS = 16
+
+# Original Flask-Mail methods, saved when init_app patches them.
+_original_configure_host = None
+_original_send = None
+
+# Background refresher: renews the cached token _TOKEN_REFRESH_AHEAD seconds
+# before expiry (inside MSAL's own 5-minute refresh window), so the send
+# path never blocks on MSAL. Waits _TOKEN_REFRESH_RETRY seconds between
+# attempts when a refresh fails or MSAL still returns the old token.
+#
+# Each mailer gets its own refresher, started by its first successful send
+# in each process (tracked by pid), not by init_app: under a pre-forking
+# server such as uWSGI without lazy-apps, init_app runs in the master and a
+# thread started there would not survive the fork into the workers.
+_TOKEN_REFRESH_AHEAD = 300
+_TOKEN_REFRESH_RETRY = 30
+_token_refresher_lock = threading.Lock()
+# GraphMailer -> (pid, stop event) of its refresher thread.
+_token_refreshers = {}
 
 
 # ---------------------------------------------------------------------------
-# Authority helper
+# Background token refresh
 # ---------------------------------------------------------------------------
 
-def _build_authority(tenant_id):
-    """Build the MSAL authority URL from a tenant identifier.
+def _refresh_tokens_forever(mailer, stop):
+    """Keep the mailer's access token fresh until stop is set.
 
-    Args:
-        tenant_id: Entra ID tenant GUID, "consumers", or "common".
+    Started after a send has acquired a token, so it first waits for that
+    token to near expiry instead of refreshing straight away.
     """
-    return f"https://login.microsoftonline.com/{tenant_id}"
-
-
-# ---------------------------------------------------------------------------
-# MSAL token management
-# ---------------------------------------------------------------------------
-
-def _get_msal_app(config):
-    """Get or create a thread-safe cached MSAL ConfidentialClientApplication."""
-    tenant_id = config["MAIL_OAUTH2_TENANT_ID"]
-    client_id = config["MAIL_OAUTH2_CLIENT_ID"]
-    flow = config["MAIL_OAUTH2_FLOW"]
-    cache_key = (tenant_id, client_id, flow)
-
-    with _msal_apps_lock:
-        if cache_key in _msal_apps:
-            return _msal_apps[cache_key]
-
-        token_cache = msal.SerializableTokenCache()
-        if flow == "delegated":
-            cache_file = config.get("MAIL_OAUTH2_TOKEN_CACHE_FILE", "")
-            if cache_file:
-                try:
-                    with open(cache_file, "r") as f:
-                        token_cache.deserialize(f.read())
-                except FileNotFoundError:
-                    pass
-
-        app = msal.ConfidentialClientApplication(
-            client_id=client_id,
-            client_credential=config["MAIL_OAUTH2_CLIENT_SECRET"],
-            authority=_build_authority(tenant_id),
-            token_cache=token_cache,
-        )
-        _msal_apps[cache_key] = app
-        return app
-
+    while True:
+        delay = _TOKEN_REFRESH_RETRY
+        expires_at = mailer.token_expires_at
+        if expires_at is not None:
+            delay = max(
+                expires_at - _TOKEN_REFRESH_AHEAD - time.monotonic(),
+                _TOKEN_REFRESH_RETRY,
+            )
+        if stop.wait(delay):
+            return
+        try:
+            mailer.acquire_token(refresh=True)
+        except Exception as exc:
+            logger.warning(
+                "Background OAuth2 token refresh failed, retrying in %ds: %s",
+                _TOKEN_REFRESH_RETRY, exc,
+            )
 
-def _persist_token_cache(config, msal_app):
-    """Atomically persist the MSAL token cache to disk.
 
-    Only relevant for the delegated flow. Writes to a temp file first,
-    then atomically replaces the target to avoid corruption. File
-    permissions are set to 0600 (owner read/write only).
-    """
-    cache_file = config.get("MAIL_OAUTH2_TOKEN_CACHE_FILE", "")
-    if not cache_file:
+def _ensure_token_refresher(mailer):
+    """Start the mailer's background token refresher, once per process."""
+    pid = os.getpid()
+    refresher = _token_refreshers.get(mailer)
+    if refresher is not None and refresher[0] == pid:
         return
 
-    cache = msal_app.token_cache
-    if not getattr(cache, "has_state_changed", False):
-        return
+    with _token_refresher_lock:
+        refresher = _token_refreshers.get(mailer)
+        if refresher is not None and refresher[0] == pid:
+            return
+        stop = threading.Event()
+        threading.Thread(
+            target=_refresh_tokens_forever,
+            args=(mailer, stop),
+            name="oauth2-token-refresher",
+            daemon=True,
+        ).start()
+        _token_refreshers[mailer] = (pid, stop)
 
-    with _cache_persist_lock:
-        tmp_file = cache_file + ".tmp"
-        try:
-            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
-            with os.fdopen(fd, "w") as f:
-                f.write(cache.serialize())
-            os.replace(tmp_file, cache_file)
-            cache.has_state_changed = False
-            logger.debug("OAuth2 token cache persisted to %s", cache_file)
-        except OSError:
-            logger.exception("Failed to persist OAuth2 token cache to %s", cache_file)
-            try:
-                os.unlink(tmp_file)
-            except OSError:
-                pass
-
-
-def _acquire_token(config):
-    """Acquire a valid OAuth2 access token.
-
-    For client_credentials: fetches a new token using app identity.
-    For delegated: silently refreshes using the cached refresh token.
 
-    Returns:
-        The access token string.
+def _stop_token_refreshers():
+    """Ask the background token refresher threads to exit."""
+    for _pid, stop in list(_token_refreshers.values()):
+        stop.set()
 
-    Raises:
-        RuntimeError: If token acquisition fails.
-    """
-    msal_app = _get_msal_app(config)
-    flow = config["MAIL_OAUTH2_FLOW"]
 
-    if flow == "client_credentials":
-        scopes = ["https://graph.microsoft.com/.default"]
-        result = msal_app.acquire_token_for_client(scopes=scopes)
-
-    elif flow == "delegated":
-        scopes = ["https://graph.microsoft.com/Mail.Send"]
-        accounts = msal_app.get_accounts()
-        if not accounts:
-            raise RuntimeError(
-                "No cached OAuth2 account found. Run "
-                "'python -m openeduarchive.mail' first."
-            )
-        result = msal_app.acquire_token_silent(
-            scopes=scopes, account=accounts[0],
-        )
-        if result and "access_token" in result:
-            _persist_token_cache(config, msal_app)
-    else:
-        raise RuntimeError(f"Invalid MAIL_OAUTH2_FLOW: '{flow}'")
-
-    if not result or "access_token" not in result:
-        error_detail = "unknown error"
-        if result:
-            error_detail = result.get(
-                "error_description", result.get("error", "unknown error")
-            )
-        raise RuntimeError(f"OAuth2 token acquisition failed: {error_detail}")
-
-    return result["access_token"]
+atexit.register(_stop_token_refreshers)
 
 
 # ---------------------------------------------------------------------------
 # Graph API email sending
 # ---------------------------------------------------------------------------
 
-def _flask_message_to_graph_payload(message, sender_email):
-    """Convert a flask_mail.Message to a Microsoft Graph API sendMail payload.
-
-    Args:
-        message: A flask_mail.Message instance.
-        sender_email: The sender email address (from config).
-
-    Returns:
-        A dict suitable for JSON serialization as the Graph API request body.
-    """
-    def _make_recipients(addresses):
-        if not addresses:
-            return []
-        return [{"emailAddress": {"address": addr}} for addr in addresses]
-
-    body = {
-        "contentType": "HTML" if message.html else "Text",
-        "content": message.html or message.body or "",
-    }
-
-    graph_message = {
-        "subject": message.subject or "",
-        "body": body,
-        "toRecipients": _make_recipients(message.recipients),
-        "ccRecipients": _make_recipients(message.cc),
-        "bccRecipients": _make_recipients(message.bcc),
-        "from": {"emailAddress": {"address": sender_email}},
-    }
-
-    if message.reply_to:
-        reply_to = message.reply_to
-        if isinstance(reply_to, str):
-            reply_to = [reply_to]
-        graph_message["replyTo"] = _make_recipients(reply_to)
-
-    return {"message": graph_message, "saveToSentItems": False}
-
-
-def _send_via_graph(message, config):
+def _send_via_graph(message, settings):
     """Send an email through the Microsoft Graph API.
 
     Args:
         message: A flask_mail.Message instance.
-        config: The Flask app config dict.
+        settings: The app's OAuth2 settings snapshot (see _snapshot_settings).
 
     Raises:
+        RetryAfter: If Graph keeps throttling the request.
         RuntimeError: If the API call fails.
     """
-    access_token = _acquire_token(config)
-    sender_email = config["MAIL_OAUTH2_SENDER_EMAIL"]
-    flow = config["MAIL_OAUTH2_FLOW"]
-
-    # /me/sendMail for delegated, /users/{email}/sendMail for app-only
-    if flow == "delegated":
-        url = f"{_GRAPH_API_SEND_URL}/me/sendMail"
-    else:
-        url = f"{_GRAPH_API_SEND_URL}/users/{quote(sender_email, safe='@')}/sendMail"
-
-    payload = _flask_message_to_graph_payload(message, sender_email)
-
-    _RETRYABLE_STATUS_CODES = {401, 429, 500, 502, 503, 504}
-    _MAX_RETRIES = 2
-    last_response = None
-
-    for attempt in range(_MAX_RETRIES + 1):
-        try:
-            last_response = requests.post(
-                url,
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "Content-Type": "application/json",
-                },
-                json=payload,
-                timeout=_GRAPH_API_TIMEOUT,
-            )
-        except requests.RequestException as exc:
-            logger.warning(
-                "Graph API request failed: %s (attempt %d/%d)",
-                exc, attempt + 1, _MAX_RETRIES + 1,
-            )
-            if attempt < _MAX_RETRIES:
-                time.sleep(2 ** attempt)
-                continue
-            raise RuntimeError(f"Graph API sendMail request failed: {exc}") from exc
-
-        if last_response.status_code == 202:
-            logger.info("Email sent via Graph API (recipients=%d)", len(message.recipients))
-            logger.debug(
-                "Email sent via Graph API: to=%s subject='%s'",
-                message.recipients,
-                message.subject,
-            )
-            return
-
-        if last_response.status_code not in _RETRYABLE_STATUS_CODES:
-            break
-
-        if attempt < _MAX_RETRIES:
-            # Re-acquire token on 401 (expired mid-flight)
-            if last_response.status_code == 401:
-                logger.warning(
-                    "Graph API returned 401, re-acquiring token (attempt %d/%d)",
-                    attempt + 1, _MAX_RETRIES,
-                )
-                access_token = _acquire_token(config)
-                wait = 1
-            elif last_response.status_code == 429:
-                # Respect Microsoft's Retry-After header on throttling
-                wait = int(last_response.headers.get("Retry-After", 2 ** attempt))
-            else:
-                wait = 2 ** attempt
-
-            logger.warning(
-                "Graph API returned %d, retrying in %ds (attempt %d/%d)",
-                last_response.status_code, wait, attempt + 1, _MAX_RETRIES,
-            )
-            time.sleep(wait)
-
-    request_id = last_response.headers.get("request-id", "?")
-    logger.error(
-        "Graph API sendMail failed: status=%d request-id=%s body=%s",
-        last_response.status_code,
-        request_id,
-        last_response.text[:500],
-    )
-    raise RuntimeError(
-        f"Graph API sendMail failed ({last_response.status_code}): "
-        f"request-id={request_id} {last_response.text[:200]}"
-    )
+    settings.mailer.send(message)
+    _ensure_token_refresher(settings.mailer)
 
 
 # ---------------------------------------------------------------------------
@@ -334,7 +164,8 @@ def _patched_configure_host(self):
     """
     from flask import current_app
 
-    if current_app.config.get("MAIL_OAUTH2_ENABLED"):
+    settings = current_app.extensions.get(_EXTENSION_KEY)
+    if settings is not None and settings.enabled:
         # Graph API does not use SMTP. Return None so Flask-Mail's
         # __exit__ skips calling host.quit().
         return None
@@ -342,22 +173,12 @@ def _patched_configure_host(self):
     return _original_configure_host(self)
 
 
-def _patched_send(self, message, envelope_from=None):
-    """Patched Flask-Mail Connection.send.
+def _prepare_message(message):
+    """Validate a flask_mail.Message before sending it via Graph API.
 
-    When OAuth2 is enabled, validates the message and sends via Graph API.
-    Otherwise delegates to the original Flask-Mail send method.
+    Applies the same checks as Flask-Mail, plus the Graph backend's own
+    limitations. Sets the message date if missing.
     """
-    from flask import current_app
-
-    if not current_app.config.get("MAIL_OAUTH2_ENABLED"):
-        return _original_send(self, message, envelope_from)
-
-    if current_app.config.get("MAIL_SUPPRESS_SEND"):
-        logger.debug("Email suppressed (MAIL_SUPPRESS_SEND=True): %s", message.subject)
-        return
-
-    # Validate message (same checks as Flask-Mail)
     if not message.send_to:
         raise ValueError("No recipients have been added")
     if not message.sender:
@@ -366,6 +187,7 @@ def _patched_send(self, message, envelope_from=None):
             "has not been configured"
         )
     if message.has_bad_headers():
+        import flask_mail
         raise flask_mail.BadHeaderError
 
     if message.date is None:
@@ -377,15 +199,154 @@ def _patched_send(self, message, envelope_from=None):
             f"Message subject: '{message.subject}'"
         )
 
-    _send_via_graph(message, current_app.config)
+
+def _patched_send(self, message, envelope_from=None):
+    """Patched Flask-Mail Connection.send.
+
+    When OAuth2 is enabled, validates the message and sends via Graph API.
+    Otherwise delegates to the original Flask-Mail send method.
+    """
+    from flask import current_app
+
+    settings = current_app.extensions.get(_EXTENSION_KEY)
+    if settings is None or not settings.enabled:
+        return _original_send(self, message, envelope_from)
+
+    if current_app.config.get("MAIL_SUPPRESS_SEND"):
+        logger.debug("Email suppressed (MAIL_SUPPRESS_SEND=True): %s", message.subject)
+        return
+
+    _prepare_message(message)
+    _send_via_graph(message, settings)
     self.num_emails += 1
 
 
 # ---------------------------------------------------------------------------
-# Configuration validation
+# Bulk sending
 # ---------------------------------------------------------------------------
 
-_VALID_FLOWS = ("client_credentials", "delegated")
+def _bulk_settings(config):
+    """Resolve and check the OAuth2 settings for the bulk sending helpers.
+
+    Uses the current app's snapshot from init_app, or a fresh snapshot of
+    an explicitly passed config.
+
+    Returns:
+        A (settings, config) tuple, config being the resolved config dict.
+    """
+    if config is None:
+        from flask import current_app
+        config = current_app.config
+        settings = current_app.extensions.get(_EXTENSION_KEY)
+    else:
+        settings = _snapshot_settings(config)
+
+    if settings is None or not settings.enabled:
+        raise RuntimeError("Bulk email sending requires MAIL_OAUTH2_ENABLED=True")
+    return settings, config
+
+
+def bulk_send(messages, config=None):
+    """Send many messages using Graph API $batch requests.
+
+    Messages are grouped 20 at a time into a single HTTP request each,
+    which suits bulk jobs such as digests or invitation runs.
+
+    Args:
+        messages: An iterable of flask_mail.Message instances.
+        config: A Flask app config dict. Defaults to the current app's
+            settings, as snapshotted by init_app.
+
+    Returns:
+        A list with one entry per message, in order: None if the message
+        was sent, or the exception describing why it was not.
+
+    Raises:
+        RuntimeError: If OAuth2 email is not enabled.
+    """
+    settings, config = _bulk_settings(config)
+
+    messages = list(messages)
+    if config.get("MAIL_SUPPRESS_SEND"):
+        logger.debug("%d emails suppressed (MAIL_SUPPRESS_SEND=True)", len(messages))
+        return [None] * len(messages)
+
+    for message in messages:
+        _prepare_message(message)
+
+    mailer = settings.mailer
+    results = []
+    for start in range(0, len(messages), GRAPH_BATCH_MAX_REQUESTS):
+        chunk = messages[start:start + GRAPH_BATCH_MAX_REQUESTS]
+        try:
+            results.extend(mailer.send_batch(chunk))
+        except Exception as exc:
+            # Keep the results of the chunks already sent, so the caller
+            # can tell which messages went out.
+            results.extend([exc] * len(chunk))
+    if any(result is None for result in results):
+        _ensure_token_refresher(mailer)
+    return results
+
+
+def send_many(messages, config=None):
+    """Send several messages concurrently through the Graph API.
+
+    Each sendMail call is independent and I/O-bound, so the messages are
+    sent from a small thread pool sharing the pooled HTTP session and a
+    single access token, instead of one round-trip after the other.
+
+    Args:
+        messages: An iterable of flask_mail.Message instances.
+        config: A Flask app config dict. Defaults to the current app's
+            settings, as snapshotted by init_app.
+
+    Returns:
+        A list with one entry per message, in order: None if the message
+        was sent, or the exception raised while sending it.
+
+    Raises:
+        RuntimeError: If OAuth2 email is not enabled.
+    """
+    settings, config = _bulk_settings(config)
+
+    messages = list(messages)
+    if not messages:
+        return []
+
+    if config.get("MAIL_SUPPRESS_SEND"):
+        logger.debug("%d emails suppressed (MAIL_SUPPRESS_SEND=True)", len(messages))
+        return [None] * len(messages)
+
+    for message in messages:
+        _prepare_message(message)
+
+    # Warm the token cache once so the workers do not race into MSAL. If
+    # that fails, no message can be sent: report it for each of them.
+    mailer = settings.mailer
+    try:
+        mailer.acquire_token()
+    except Exception as exc:
+        return [exc] * len(messages)
+
+    def _send_one(message):
+        try:
+            mailer.send(message)
+        except Exception as exc:
+            return exc
+        return None
+
+    workers = min(_SEND_MANY_MAX_WORKERS, len(messages))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_send_one, messages))
+    if any(result is None for result in results):
+        _ensure_token_refresher(mailer)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Configuration validation
+# ---------------------------------------------------------------------------
 
 _REQUIRED_CONFIG_KEYS = (
     "MAIL_OAUTH2_TENANT_ID",
@@ -402,9 +363,9 @@ def _validate_config(config):
             raise RuntimeError(f"MAIL_OAUTH2_ENABLED is True but {key} is empty")
 
     flow = config.get("MAIL_OAUTH2_FLOW", "")
-    if flow not in _VALID_FLOWS:
+    if flow not in VALID_FLOWS:
         raise RuntimeError(
-            f"MAIL_OAUTH2_FLOW must be one of {_VALID_FLOWS}, got '{flow}'"
+            f"MAIL_OAUTH2_FLOW must be one of {VALID_FLOWS}, got '{flow}'"
         )
 
     if flow == "delegated":
@@ -447,6 +408,24 @@ _CONFIG_DEFAULTS = {
 }
 
 
+_EXTENSION_KEY = "openeduarchive_oauth2"
+
+
+def _snapshot_settings(config):
+    """Snapshot the OAuth2 mail settings the send path needs.
+
+    Read once in init_app so that the patched Flask-Mail methods use plain
+    attribute access instead of config lookups on every message.
+    MAIL_SUPPRESS_SEND is left out on purpose and read at send time, since
+    tests and tooling change it after init_app.
+    """
+    enabled = bool(config.get("MAIL_OAUTH2_ENABLED"))
+    return types.SimpleNamespace(
+        enabled=enabled,
+        mailer=get_mailer(config) if enabled else None,
+    )
+
+
 def init_app(app):
     """Initialize OAuth2 email sending for a Flask/Invenio application.
 
@@ -454,11 +433,19 @@ def init_app(app):
     1. Sets configuration defaults.
     2. Validates configuration if OAuth2 is enabled.
     3. Monkey-patches Flask-Mail to route emails through Graph API.
+    4. Snapshots the settings used by the send path into
+       app.extensions["openeduarchive_oauth2"].
 
-    The patches are safe to apply even when OAuth2 is disabled — they
-    check MAIL_OAUTH2_ENABLED at runtime and fall back to the original
-    Flask-Mail behavior when it is False.
+    Flask-Mail is only patched once an app enables OAuth2, so deployments
+    that leave it disabled keep the stock SMTP transport untouched. The
+    patches still check MAIL_OAUTH2_ENABLED at runtime and fall back to
+    the original Flask-Mail behavior for apps where it is False.
+
+    No network I/O happens here: tokens are first acquired, and the
+    background token refresher started, by the first send in each process.
     """
+    global _original_configure_host, _original_send
+
     for key, default in _CONFIG_DEFAULTS.items():
         app.config.setdefault(key, default)
 
@@ -476,8 +463,14 @@ def init_app(app):
             app.config["MAIL_OAUTH2_SENDER_EMAIL"],
         )
 
-    # Apply patches once — runtime checks handle the fallback.
-    if not getattr(init_app, "_patched", False):
-        flask_mail.Connection.configure_host = _patched_configure_host
-        flask_mail.Connection.send = _patched_send
-        init_app._patched = True
+        # Apply patches once — runtime checks handle the fallback.
+        if not getattr(init_app, "_patched", False):
+            import flask_mail
+
+            _original_configure_host = flask_mail.Connection.configure_host
+            _original_send = flask_mail.Connection.send
+            flask_mail.Connection.configure_host = _patched_configure_host
+            flask_mail.Connection.send = _patched_send
+            init_app._patched = True
+
+    app.extensions[_EXTENSION_KEY] = _snapshot_settings(app.config)
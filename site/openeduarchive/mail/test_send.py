@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """Standalone test script for Graph API email sending.
 
-Replicates the exact logic of oauth2.py without any Invenio/Flask dependency.
+Uses the same Graph client as oauth2.py (_graph.GraphMailer), without any
+Invenio/Flask dependency.
 Supports both 'delegated' and 'client_credentials' flows.
 
 Usage:
@@ -24,10 +25,10 @@ Delegated flow only:
     MAIL_OAUTH2_TOKEN_CACHE_FILE - Path to token cache from token_setup.py
 """
 
+import logging
 import os
 import sys
 import time
-from urllib.parse import quote
 
 try:
     from dotenv import load_dotenv
@@ -35,11 +36,10 @@ try:
 except ImportError:
     pass
 
-import msal
-import requests
-
-GRAPH_API = "https://graph.microsoft.com/v1.0"
-TIMEOUT = 30
+try:
+    from ._graph import GraphMailer, build_authority
+except ImportError:  # run as a plain script: python3 test_send.py
+    from _graph import GraphMailer, build_authority
 
 _SENSITIVE_KEYS = {"MAIL_OAUTH2_CLIENT_SECRET"}
 
@@ -61,169 +61,61 @@ def env_required(key):
     return val
 
 
-def acquire_token_delegated(tenant_id, client_id, client_secret, cache_file):
-    """Acquire token via delegated flow (refresh token from cache)."""
-    print("\n--- Token Acquisition (delegated) ---")
-
-    cache = msal.SerializableTokenCache()
-    try:
-        with open(cache_file, "r") as f:
-            cache.deserialize(f.read())
-        print(f"  Loaded token cache from {cache_file}")
-    except FileNotFoundError:
-        print(f"  ERROR: Cache file not found: {cache_file}")
-        print(f"  Run token_setup.py first.")
-        sys.exit(1)
-
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    print(f"  Authority: {authority}")
-
-    app = msal.ConfidentialClientApplication(
-        client_id=client_id,
-        client_credential=client_secret,
-        authority=authority,
-        token_cache=cache,
-    )
-
-    accounts = app.get_accounts()
-    if not accounts:
-        print("  ERROR: No cached accounts found. Run token_setup.py first.")
-        sys.exit(1)
-
-    print(f"  Cached account: {accounts[0].get('username', '?')}")
-    print("  Calling acquire_token_silent...")
-
-    result = app.acquire_token_silent(
-        scopes=["https://graph.microsoft.com/Mail.Send"],
-        account=accounts[0],
-    )
-
-    if not result or "access_token" not in result:
-        print(f"  ERROR: Token acquisition failed:")
-        if result:
-            print(f"    error: {result.get('error', '?')}")
-            print(f"    description: {result.get('error_description', '?')}")
-        else:
-            print(f"    result is None")
-        sys.exit(1)
-
-    print(f"  OK — Got access token ({len(result['access_token'])} chars)")
-    print(f"  Expires in: {result.get('expires_in', '?')}s")
-    return result["access_token"]
-
-
-def acquire_token_client_credentials(tenant_id, client_id, client_secret):
-    """Acquire token via client_credentials flow (app-only)."""
-    print("\n--- Token Acquisition (client_credentials) ---")
-
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    print(f"  Authority: {authority}")
-
-    app = msal.ConfidentialClientApplication(
-        client_id=client_id,
-        client_credential=client_secret,
-        authority=authority,
-    )
+def acquire_token(mailer):
+    """Acquire an access token through the shared Graph client."""
+    print(f"\n--- Token Acquisition ({mailer.flow}) ---")
+    print(f"  Authority: {build_authority(mailer.tenant_id)}")
 
-    print("  Calling acquire_token_for_client...")
-    result = app.acquire_token_for_client(
-        scopes=["https://graph.microsoft.com/.default"],
-    )
+    if mailer.flow == "delegated":
+        if not os.path.exists(mailer.token_cache_file):
+            print(f"  ERROR: Cache file not found: {mailer.token_cache_file}")
+            print(f"  Run token_setup.py first.")
+            sys.exit(1)
+        print(f"  Token cache: {mailer.token_cache_file}")
 
-    if not result or "access_token" not in result:
-        print(f"  ERROR: Token acquisition failed:")
-        if result:
-            print(f"    error: {result.get('error', '?')}")
-            print(f"    description: {result.get('error_description', '?')}")
-        else:
-            print(f"    result is None")
+    try:
+        token = mailer.acquire_token(refresh=True)
+    except RuntimeError as e:
+        print(f"  ERROR: {e}")
         sys.exit(1)
 
-    print(f"  OK — Got access token ({len(result['access_token'])} chars)")
-    print(f"  Expires in: {result.get('expires_in', '?')}s")
-    return result["access_token"]
+    print(f"  OK — Got access token ({len(token)} chars)")
+    expires_at = mailer.token_expires_at
+    if expires_at is not None:
+        print(f"  Expires in: {int(expires_at - time.monotonic())}s")
+    return token
 
 
-def send_email(access_token, flow, sender_email, recipient, token_acquirer=None):
-    """Send a test email via Graph API, with retry logic."""
+def send_email(mailer, recipient):
+    """Send a test email via Graph API (retries are handled by the mailer)."""
     print("\n--- Sending Email ---")
-
-    if flow == "delegated":
-        url = f"{GRAPH_API}/me/sendMail"
-    else:
-        url = f"{GRAPH_API}/users/{quote(sender_email, safe='@')}/sendMail"
-
-    print(f"  URL: {url}")
-    print(f"  From: {sender_email}")
+    print(f"  From: {mailer.sender_email}")
     print(f"  To: {recipient}")
 
     payload = {
         "message": {
-            "subject": f"Test OAuth2 ({flow}) — {time.strftime('%H:%M:%S')}",
+            "subject": f"Test OAuth2 ({mailer.flow}) — {time.strftime('%H:%M:%S')}",
             "body": {
                 "contentType": "Text",
                 "content": (
                     f"Test email sent via Microsoft Graph API.\n"
-                    f"Flow: {flow}\n"
+                    f"Flow: {mailer.flow}\n"
                     f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}"
                 ),
             },
             "toRecipients": [{"emailAddress": {"address": recipient}}],
-            "from": {"emailAddress": {"address": sender_email}},
+            "from": {"emailAddress": {"address": mailer.sender_email}},
         },
         "saveToSentItems": False,
     }
 
-    retryable = {401, 429, 500, 502, 503, 504}
-    max_retries = 2
-
-    for attempt in range(max_retries + 1):
-        print(f"\n  Attempt {attempt + 1}/{max_retries + 1}...")
-        try:
-            response = requests.post(
-                url,
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "Content-Type": "application/json",
-                },
-                json=payload,
-                timeout=TIMEOUT,
-            )
-        except requests.RequestException as e:
-            print(f"  ERROR: Request failed: {e}")
-            if attempt < max_retries:
-                wait = 2 ** attempt
-                print(f"  Retrying in {wait}s...")
-                time.sleep(wait)
-                continue
-            sys.exit(1)
-
-        print(f"  Status: {response.status_code}")
-        print(f"  Request-ID: {response.headers.get('request-id', '?')}")
-
-        if response.status_code == 202:
-            print(f"\n  SUCCESS — Email sent to {recipient}")
-            return
-
-        print(f"  Response: {response.text[:500]}")
-
-        if response.status_code not in retryable:
-            break
-
-        if attempt < max_retries:
-            if response.status_code == 401 and token_acquirer:
-                print(f"  Got 401, re-acquiring token...")
-                access_token = token_acquirer()
-                wait = 1
-            elif response.status_code == 429:
-                wait = int(response.headers.get("Retry-After", 2 ** attempt))
-            else:
-                wait = 2 ** attempt
-            print(f"  Retrying in {wait}s...")
-            time.sleep(wait)
+    try:
+        mailer.send(payload)
+    except RuntimeError as e:
+        print(f"\n  FAILED — Could not send email: {e}")
+        sys.exit(1)
 
-    print(f"\n  FAILED — Could not send email")
-    sys.exit(1)
+    print(f"\n  SUCCESS — Email sent to {recipient}")
 
 
 def main():
@@ -248,6 +140,9 @@ def main():
         print(f"ERROR: Invalid flow '{flow}'. Must be 'delegated' or 'client_credentials'.")
         sys.exit(1)
 
+    # Show the mailer's retry/error log lines alongside the script output.
+    logging.basicConfig(level=logging.INFO, format="  %(levelname)s: %(message)s")
+
     print(f"=== Graph API Email Test ===")
     print(f"Flow: {flow}")
     print(f"Recipient: {recipient}")
@@ -271,13 +166,17 @@ def main():
         print("\nERROR: Missing required environment variables (see above).")
         sys.exit(1)
 
-    # Acquire token
-    if flow == "delegated":
-        token_acquirer = lambda: acquire_token_delegated(tenant_id, client_id, client_secret, cache_file)
-    else:
-        token_acquirer = lambda: acquire_token_client_credentials(tenant_id, client_id, client_secret)
+    mailer = GraphMailer(
+        tenant_id=tenant_id,
+        client_id=client_id,
+        client_secret=client_secret,
+        flow=flow,
+        sender_email=sender_email,
+        token_cache_file=cache_file,
+    )
 
-    token = token_acquirer()
+    # Acquire token
+    token = acquire_token(mailer)
 
     if dry_run:
         print(f"\n--- Dry Run ---")
@@ -287,7 +186,7 @@ def main():
         return
 
     # Send email
-    send_email(token, flow, sender_email, recipient, token_acquirer=token_acquirer)
+    send_email(mailer, recipient)
 
 
 if __name__ == "__main__":
@@ -22,9 +22,11 @@ Prerequisites:
       (Authentication > Add a platform > Web)
 """
 
+import atexit
+import logging
 import os
+import stat
 import sys
-import threading
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs, urlparse
 
@@ -45,17 +47,23 @@ _REDIRECT_URI = f"http://localhost:{_REDIRECT_PORT}"
 _SCOPES = ["https://graph.microsoft.com/Mail.Send"]
 _CALLBACK_TIMEOUT = 300  # 5 minutes
 
-# Shared state between the HTTP handler and the main thread.
-_auth_result = {"response": {}}
-_auth_received = threading.Event()
-
 
 class _OAuthCallbackHandler(BaseHTTPRequestHandler):
-    """Minimal HTTP handler that captures the OAuth2 redirect."""
+    """Minimal HTTP handler that captures the OAuth2 redirect.
+
+    Stores the redirect's query parameters in the server's shared_state
+    dict, set up by main() before handling the request.
+    """
+
+    # server.timeout only bounds the wait for a connection; this bounds
+    # reads on an accepted one, so an idle preconnect cannot hang main().
+    timeout = _CALLBACK_TIMEOUT
 
     def do_GET(self):
         params = parse_qs(urlparse(self.path).query)
-        _auth_result["response"] = {k: v[0] if len(v) == 1 else v for k, v in params.items()}
+        self.server.shared_state["response"] = {
+            k: v[0] if len(v) == 1 else v for k, v in params.items()
+        }
 
         self.send_response(200)
         self.send_header("Content-Type", "text/html; charset=utf-8")
@@ -66,19 +74,25 @@ class _OAuthCallbackHandler(BaseHTTPRequestHandler):
             b"<p>You can close this tab.</p>"
             b"</body></html>"
         )
-        _auth_received.set()
 
     def log_message(self, format, *args):
         """Suppress default HTTP request logging."""
 
 
 def _save_cache(cache, path):
-    """Atomically write the token cache with secure permissions (0600)."""
+    """Atomically write the token cache with secure permissions (0600).
+
+    Does nothing if the cache has not changed since it was loaded or
+    last saved.
+    """
+    if not cache.has_state_changed:
+        return
     tmp = path + ".tmp"
     fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
     with os.fdopen(fd, "w") as f:
         f.write(cache.serialize())
     os.replace(tmp, path)
+    cache.has_state_changed = False
     print(f"Token cache saved to {path}")
 
 
@@ -101,28 +115,38 @@ def _read_required_env():
 
 
 def main():
+    # Keep MSAL from formatting INFO/DEBUG records on every cache lookup
+    logging.getLogger("msal").setLevel(logging.WARNING)
+
     env = _read_required_env()
     tenant_id = env["MAIL_OAUTH2_TENANT_ID"]
     client_id = env["MAIL_OAUTH2_CLIENT_ID"]
     client_secret = env["MAIL_OAUTH2_CLIENT_SECRET"]
     cache_file = env["MAIL_OAUTH2_TOKEN_CACHE_FILE"]
 
-    # Load existing cache if present
+    # Load existing cache if present (one stat for existence and mode)
     cache = msal.SerializableTokenCache()
-    if os.path.exists(cache_file):
+    try:
+        st = os.stat(cache_file)
+    except FileNotFoundError:
+        st = None
+    if st is not None:
         # Warn if permissions are too open
+        mode = stat.S_IMODE(st.st_mode)
+        if mode & (stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH):
+            print(
+                f"WARNING: Token cache '{cache_file}' is accessible by "
+                f"group/others (mode={oct(mode)}). Fix with: chmod 600 {cache_file}"
+            )
+        fd = os.open(cache_file, os.O_RDONLY)
         try:
-            import stat
-            mode = stat.S_IMODE(os.stat(cache_file).st_mode)
-            if mode & (stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH):
-                print(
-                    f"WARNING: Token cache '{cache_file}' is accessible by "
-                    f"group/others (mode={oct(mode)}). Fix with: chmod 600 {cache_file}"
-                )
-        except OSError:
-            pass
-        with open(cache_file, "r") as f:
-            cache.deserialize(f.read())
+            data = os.read(fd, st.st_size)
+        finally:
+            os.close(fd)
+        cache.deserialize(data.decode("utf-8"))
+
+    # Persist any refresh done below once, whichever way main() exits
+    atexit.register(_save_cache, cache, cache_file)
 
     authority = f"https://login.microsoftonline.com/{tenant_id}"
     app = msal.ConfidentialClientApplication(
@@ -140,13 +164,13 @@ def main():
         result = app.acquire_token_silent(scopes=_SCOPES, account=account)
         if result and "access_token" in result:
             print("Refresh token is still valid. No action needed.")
-            _save_cache(cache, cache_file)
             return
 
-    # Start local callback server
+    # Bind the local callback server before the browser is sent to login
     server = HTTPServer(("127.0.0.1", _REDIRECT_PORT), _OAuthCallbackHandler)
-    thread = threading.Thread(target=server.handle_request, daemon=True)
-    thread.start()
+    server.timeout = _CALLBACK_TIMEOUT
+    auth_result = {"response": {}}
+    server.shared_state = auth_result
 
     # Initiate authorization code flow
     auth_flow = app.initiate_auth_code_flow(
@@ -169,22 +193,23 @@ def main():
     webbrowser.open(auth_flow["auth_uri"])
 
     print("\nWaiting for authentication (timeout: 5 minutes)...")
-    _auth_received.wait(timeout=_CALLBACK_TIMEOUT)
+    # Serves the single OAuth2 redirect, or returns after server.timeout
+    server.handle_request()
     server.server_close()
 
-    if not _auth_result["response"]:
+    if not auth_result["response"]:
         print("ERROR: Authentication timed out.")
         sys.exit(1)
 
-    if "error" in _auth_result["response"]:
-        desc = _auth_result["response"].get("error_description", _auth_result["response"]["error"])
+    if "error" in auth_result["response"]:
+        desc = auth_result["response"].get("error_description", auth_result["response"]["error"])
         print(f"ERROR: Authentication failed: {desc}")
         sys.exit(1)
 
     # Exchange authorization code for tokens
     result = app.acquire_token_by_auth_code_flow(
         auth_code_flow=auth_flow,
-        auth_response=_auth_result["response"],
+        auth_response=auth_result["response"],
     )
     if "access_token" not in result:
         error = result.get("error_description", result.get("error", "unknown"))
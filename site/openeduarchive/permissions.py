@@ -10,6 +10,8 @@
 # Original work: https://github.com/Samk13/rdm-restricted-permissions/tree/master
 # Original license at <https://opensource.org/licenses/MIT>.
 
+from weakref import WeakKeyDictionary, ref
+
 from flask import abort, current_app
 from flask_principal import RoleNeed
 from invenio_administration.generators import Administration
@@ -25,15 +27,48 @@ from invenio_records_permissions.generators import (
 )
 
 
+# Community manager needs per Flask app, resolved from the app config on
+# first use. Permission checks run on every community/record request.
+_community_manager_needs = WeakKeyDictionary()
+
+
 class CommunityManager(Generator):
     """Allows users with the community manager role to perform an action."""
 
+    def __init__(self):
+        """Constructor."""
+        super().__init__()
+        # (weak reference to the app, needs) of the last app seen
+        self._cached_needs = None
+
     def needs(self, record=None, **kwargs):
         """Enabling Needs."""
-        role_name = current_app.config.get(
-            "CONFIG_OEA_COMMUNITY_MANAGER_ROLE", "community-manager"
-        )
-        return [RoleNeed(role_name)]
+        app = current_app._get_current_object()
+        cached = self._cached_needs
+        if cached is not None and cached[0]() is app:
+            return cached[1]
+
+        needs = _community_manager_needs.get(app)
+        if needs is None:
+            role_name = app.config.get(
+                "CONFIG_OEA_COMMUNITY_MANAGER_ROLE", "community-manager"
+            )
+            needs = _community_manager_needs[app] = (RoleNeed(role_name),)
+        self._cached_needs = (ref(app), needs)
+        return needs
+
+
+def _community_count(record):
+    """Number of communities of a record's parent.
+
+    Uses the relation's own length when it has one, instead of building
+    the full list of community ids.
+    """
+    communities = record.parent.communities
+    try:
+        return len(communities)
+    except TypeError:
+        return len(communities.ids)
 
 
 class IfInCommunity(ConditionalGenerator):
@@ -41,7 +76,7 @@ class IfInCommunity(ConditionalGenerator):
 
     def _condition(self, record, **kwargs):
         """Check if the record is part of a community."""
-        if not record or not record.parent.communities.ids:
+        if record is None or _community_count(record) == 0:
             abort(403, description=_("Please select a community before publishing."))
         return True
 
@@ -51,7 +86,7 @@ class IfOneCommunity(ConditionalGenerator):
 
     def _condition(self, record, **kwargs):
         """Check if the record is part of a community."""
-        if not record or len(record.parent.communities.ids) == 1:
+        if record is None or _community_count(record) == 1:
             raise RecordCommunityMissing("", "One community per record is required")
         return True
 
@@ -67,6 +102,13 @@ class OEACommunitiesPermissionPolicy(CommunityPermissionPolicy):
     can_include_directly = [Disable()]
 
 
+# Upstream generators, frozen once at import time and shared by the
+# conditional generators below.
+_PARENT_PUBLISH = tuple(RDMRecordPermissionPolicy.can_publish)
+_PARENT_REMOVE_COMMUNITY = tuple(RDMRecordPermissionPolicy.can_remove_community)
+_SYSTEM_PROCESS_ONLY = (SystemProcess(),)
+
+
 class OEARecordPermissionPolicy(RDMRecordPermissionPolicy):
     """Record permission policy of Open Education Archive.
 
@@ -75,15 +117,15 @@ class OEARecordPermissionPolicy(RDMRecordPermissionPolicy):
 
     can_publish = [
         IfInCommunity(
-            then_=RDMRecordPermissionPolicy.can_publish,
-            else_=[SystemProcess()]
+            then_=_PARENT_PUBLISH,
+            else_=_SYSTEM_PROCESS_ONLY,
         )
     ]
 
     # Remove community from an already created record just if it has more than one community
     can_remove_community = [
         IfOneCommunity(
-            then_=RDMRecordPermissionPolicy.can_remove_community,
-            else_=[SystemProcess()],
+            then_=_PARENT_REMOVE_COMMUNITY,
+            else_=_SYSTEM_PROCESS_ONLY,
         )
     ]
@@ -0,0 +1,233 @@
+"""Tests for the Graph API mail client in openeduarchive.mail._graph."""
+
+import json
+import types
+
+import pytest
+
+from openeduarchive.mail import _graph
+from openeduarchive.mail._graph import GraphMailer, RetryAfter
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body
+        self.text = json.dumps(body) if body is not None else ""
+
+    def json(self):
+        return self._body
+
+
+class FakeSession:
+    """Stand-in for requests.Session that replays scripted responses."""
+
+    def __init__(self, *responses):
+        self._responses = list(responses)
+        self.posts = []
+        self.headers = []
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.posts.append((url, json.loads(data)))
+        self.headers.append(headers)
+        if len(self._responses) > 1:
+            return self._responses.pop(0)
+        return self._responses[0]
+
+
+def _payload(address):
+    return {
+        "message": {
+            "subject": "Test",
+            "body": {"contentType": "Text", "content": "Hello"},
+            "toRecipients": [{"emailAddress": {"address": address}}],
+        },
+        "saveToSentItems": False,
+    }
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(_graph.time, "sleep", waits.append)
+    monkeypatch.setattr(_graph, "_jitter", lambda wait: wait)
+    return waits
+
+
+@pytest.fixture
+def graph_mailer():
+    return GraphMailer(
+        tenant_id="tenant",
+        client_id="client",
+        client_secret="secret",
+        flow="client_credentials",
+        sender_email="noreply@example.org",
+    )
+
+
+@pytest.fixture
+def mailer(graph_mailer, monkeypatch):
+    mailer = graph_mailer
+    monkeypatch.setattr(mailer, "acquire_token", lambda refresh=False: "token")
+    monkeypatch.setattr(mailer, "invalidate_token", lambda: None)
+    return mailer
+
+
+def test_send_accepted(mailer, sleeps):
+    mailer._http = FakeSession(FakeResponse(202))
+
+    mailer.send(_payload("user@example.org"))
+
+    assert [url for url, _ in mailer._http.posts] == [mailer._send_url]
+    assert sleeps == []
+
+
+def test_send_throttled_above_cap_raises_retry_after(mailer, sleeps, caplog):
+    mailer._http = FakeSession(
+        FakeResponse(429, headers={"Retry-After": "120", "request-id": "abc"})
+    )
+
+    with pytest.raises(RetryAfter) as excinfo:
+        mailer.send(_payload("user@example.org"))
+
+    assert excinfo.value.retry_after == 120
+    assert len(mailer._http.posts) == 1
+    assert sleeps == []
+    assert "request-id=abc" in caplog.text
+
+
+def test_send_exhausted_5xx_raises(mailer, sleeps):
+    mailer._http = FakeSession(FakeResponse(503))
+
+    with pytest.raises(RuntimeError, match=r"\(503\)"):
+        mailer.send(_payload("user@example.org"))
+
+    assert len(mailer._http.posts) == _graph._MAX_RETRIES + 1
+    assert len(sleeps) == _graph._MAX_RETRIES
+
+
+def test_send_batch_retries_only_failed_sub_requests(mailer, sleeps):
+    mailer._http = FakeSession(
+        FakeResponse(200, {"responses": [
+            {"id": "0", "status": 202},
+            {"id": "1", "status": 429, "headers": {"Retry-After": "3"}},
+            {"id": "2", "status": 503},
+            {"id": "3", "status": 400,
+             "body": {"error": {"code": "ErrorInvalidRecipients", "message": "bad"}}},
+        ]}),
+        FakeResponse(200, {"responses": [
+            {"id": "1", "status": 202},
+            {"id": "2", "status": 202},
+        ]}),
+    )
+    messages = [_payload(f"user{i}@example.org") for i in range(4)]
+
+    results = mailer.send_batch(messages)
+
+    assert results[:3] == [None, None, None]
+    assert isinstance(results[3], RuntimeError)
+    assert "ErrorInvalidRecipients" in str(results[3])
+
+    (url, first), (_, second) = mailer._http.posts
+    assert url == mailer._batch_url
+    assert [r["id"] for r in first["requests"]] == ["0", "1", "2", "3"]
+    assert [r["id"] for r in second["requests"]] == ["1", "2"]
+    # One wait for the whole retry batch: the largest of Retry-After (3s)
+    # and the 5xx backoff (1s).
+    assert sleeps == [3]
+
+
+def test_send_batch_token_failure_is_per_message(mailer, sleeps, monkeypatch):
+    def fail(refresh=False):
+        raise RuntimeError("Failed to acquire OAuth2 token")
+
+    monkeypatch.setattr(mailer, "acquire_token", fail)
+    mailer._http = FakeSession(FakeResponse(200, {"responses": []}))
+
+    results = mailer.send_batch([_payload("a@example.org"), _payload("b@example.org")])
+
+    assert [str(r) for r in results] == ["Failed to acquire OAuth2 token"] * 2
+    assert mailer._http.posts == []
+
+
+def test_send_batch_malformed_json_is_per_message(mailer, sleeps):
+    class MalformedResponse(FakeResponse):
+        def json(self):
+            raise ValueError("Expecting value")
+
+    mailer._http = FakeSession(MalformedResponse(200))
+
+    results = mailer.send_batch([_payload("a@example.org"), _payload("b@example.org")])
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert "malformed JSON" in str(results[0])
+
+
+class FakeMsalApp:
+    """Stand-in for msal.ConfidentialClientApplication issuing numbered tokens."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def acquire_token_for_client(self, scopes):
+        self.calls += 1
+        return {"access_token": f"token-{self.calls}", "expires_in": 3600}
+
+
+def test_acquire_token_served_from_cache(graph_mailer):
+    graph_mailer._msal_app = msal_app = FakeMsalApp()
+
+    assert graph_mailer.acquire_token() == "token-1"
+    assert graph_mailer.acquire_token() == "token-1"
+    assert msal_app.calls == 1
+
+    assert graph_mailer.acquire_token(refresh=True) == "token-2"
+    assert msal_app.calls == 2
+
+
+def test_send_drops_cached_token_on_401(graph_mailer, sleeps):
+    graph_mailer._msal_app = msal_app = FakeMsalApp()
+    graph_mailer._http = FakeSession(FakeResponse(401), FakeResponse(202))
+
+    graph_mailer.send(_payload("user@example.org"))
+
+    assert msal_app.calls == 2
+    assert [h["Authorization"] for h in graph_mailer._http.headers] == [
+        "Bearer token-1",
+        "Bearer token-2",
+    ]
+    assert graph_mailer.acquire_token() == "token-2"
+
+
+def test_payload_omits_empty_cc_and_bcc():
+    message = types.SimpleNamespace(
+        subject="Hi", html=None, body="Hello", recipients=["user@example.org"],
+        cc=[], bcc=[], reply_to=None,
+    )
+
+    graph_message = _graph.flask_message_to_graph_payload(
+        message, "noreply@example.org"
+    )["message"]
+
+    assert "ccRecipients" not in graph_message
+    assert "bccRecipients" not in graph_message
+    assert graph_message["toRecipients"] == [
+        {"emailAddress": {"address": "user@example.org"}}
+    ]
+
+
+def test_payload_includes_cc_bcc_and_reply_to():
+    message = types.SimpleNamespace(
+        subject="Hi", html="<p>Hello</p>", body=None, recipients=["user@example.org"],
+        cc=["cc@example.org"], bcc=["bcc@example.org"], reply_to="reply@example.org",
+    )
+
+    graph_message = _graph.flask_message_to_graph_payload(
+        message, "noreply@example.org"
+    )["message"]
+
+    assert graph_message["body"]["contentType"] == "HTML"
+    assert graph_message["ccRecipients"] == [{"emailAddress": {"address": "cc@example.org"}}]
+    assert graph_message["bccRecipients"] == [{"emailAddress": {"address": "bcc@example.org"}}]
+    assert graph_message["replyTo"] == [{"emailAddress": {"address": "reply@example.org"}}]
@@ -0,0 +1,147 @@
+"""Tests for the Flask-Mail integration in openeduarchive.mail.oauth2."""
+
+import types
+
+import pytest
+from flask import Flask
+from flask_mail import Message
+
+from openeduarchive.mail import oauth2
+
+CONFIG = {"MAIL_OAUTH2_ENABLED": True, "MAIL_SUPPRESS_SEND": False}
+
+
+class FakeMailer:
+    """Stand-in for GraphMailer that records the $batch chunks."""
+
+    def __init__(self, fail_on_chunk=None):
+        self.chunks = []
+        self._fail_on_chunk = fail_on_chunk
+
+    def send_batch(self, messages):
+        self.chunks.append(list(messages))
+        if len(self.chunks) == self._fail_on_chunk:
+            raise RuntimeError("boom")
+        return [message.subject for message in messages]
+
+
+def _message(i):
+    return Message(f"msg-{i}", sender="noreply@example.org", recipients=["a@example.org"])
+
+
+@pytest.fixture
+def fake_mailer(monkeypatch):
+    def install(**kwargs):
+        mailer = FakeMailer(**kwargs)
+        monkeypatch.setattr(oauth2, "get_mailer", lambda config: mailer)
+        return mailer
+
+    monkeypatch.setattr(oauth2, "_ensure_token_refresher", lambda mailer: None)
+    return install
+
+
+def test_bulk_send_chunks_and_keeps_order(fake_mailer):
+    mailer = fake_mailer()
+    messages = [_message(i) for i in range(45)]
+
+    results = oauth2.bulk_send(messages, CONFIG)
+
+    assert [len(chunk) for chunk in mailer.chunks] == [20, 20, 5]
+    assert results == [f"msg-{i}" for i in range(45)]
+
+
+def test_bulk_send_keeps_results_of_sent_chunks(fake_mailer):
+    fake_mailer(fail_on_chunk=2)
+    messages = [_message(i) for i in range(45)]
+
+    results = oauth2.bulk_send(messages, CONFIG)
+
+    assert results[:20] == [f"msg-{i}" for i in range(20)]
+    assert [str(r) for r in results[20:40]] == ["boom"] * 20
+    assert results[40:] == [f"msg-{i}" for i in range(40, 45)]
+
+
+class FakeConnection:
+    num_emails = 0
+
+
+class RecordingMailer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    app = Flask("testapp")
+    monkeypatch.setattr(
+        oauth2, "_original_send", lambda self, message, envelope_from=None: "smtp"
+    )
+    monkeypatch.setattr(oauth2, "_ensure_token_refresher", lambda mailer: None)
+    with app.app_context():
+        yield app
+
+
+def test_patched_send_falls_back_without_snapshot(app):
+    assert oauth2._patched_send(FakeConnection(), _message(0)) == "smtp"
+
+
+def test_patched_send_falls_back_when_disabled(app):
+    app.extensions[oauth2._EXTENSION_KEY] = oauth2._snapshot_settings(
+        {"MAIL_OAUTH2_ENABLED": False}
+    )
+
+    assert oauth2._patched_send(FakeConnection(), _message(0)) == "smtp"
+
+
+def test_patched_send_reads_suppress_send_at_send_time(app):
+    mailer = RecordingMailer()
+    app.extensions[oauth2._EXTENSION_KEY] = types.SimpleNamespace(
+        enabled=True, mailer=mailer
+    )
+    connection = FakeConnection()
+
+    app.config["MAIL_SUPPRESS_SEND"] = True
+    oauth2._patched_send(connection, _message(0))
+    assert mailer.sent == []
+
+    app.config["MAIL_SUPPRESS_SEND"] = False
+    oauth2._patched_send(connection, _message(1))
+    assert [m.subject for m in mailer.sent] == ["msg-1"]
+    assert connection.num_emails == 1
+
+
+def test_each_mailer_gets_its_own_token_refresher(monkeypatch):
+    monkeypatch.setattr(oauth2, "_token_refreshers", {})
+    monkeypatch.setattr(oauth2, "_refresh_tokens_forever", lambda mailer, stop: None)
+    first, second = FakeMailer(), FakeMailer()
+
+    for mailer in (first, second, first):
+        oauth2._ensure_token_refresher(mailer)
+
+    assert list(oauth2._token_refreshers) == [first, second]
+
+
+def test_bulk_send_without_messages_starts_no_refresher(fake_mailer, monkeypatch):
+    fake_mailer()
+    started = []
+    monkeypatch.setattr(oauth2, "_ensure_token_refresher", started.append)
+
+    assert oauth2.bulk_send([], CONFIG) == []
+    assert started == []
+
+
+def test_send_many_reports_token_failure_per_message(monkeypatch):
+    class NoTokenMailer(RecordingMailer):
+        def acquire_token(self, refresh=False):
+            raise RuntimeError("Failed to acquire OAuth2 token")
+
+    mailer = NoTokenMailer()
+    monkeypatch.setattr(oauth2, "get_mailer", lambda config: mailer)
+
+    results = oauth2.send_many([_message(0), _message(1)], CONFIG)
+
+    assert [str(r) for r in results] == ["Failed to acquire OAuth2 token"] * 2
+    assert mailer.sent == []